@@ -1,15 +1,34 @@
 import os
-import json
-import random
+import orjson
+import time
+import hashlib
+import re
+import difflib
 import secrets
 import mysql.connector
+from mysql.connector import pooling, errorcode
 import google.generativeai as genai
-from fastapi import FastAPI, HTTPException
+from google.api_core import exceptions as google_exceptions
+from fastapi import FastAPI, HTTPException, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import StreamingResponse, ORJSONResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
-from typing import Optional, Set, List, Dict
+from typing import Optional, Set, List, Dict, Callable, Tuple
+from collections import OrderedDict, defaultdict, deque
 import traceback
+import asyncio
+import threading
+import anyio
+from contextvars import ContextVar
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# --- JSON ---
+# orjson is a hard requirement (it also renders every response via ORJSONResponse); these keep call sites working in str
+def json_loads(data): return orjson.loads(data)
+def json_dumps(obj) -> str: return orjson.dumps(obj).decode()
 
 # --- System-Wide Persona Prompt ---
 SYSTEM_PERSONA_PROMPT = """
@@ -18,165 +37,490 @@ You must NEVER discuss non-math subjects unless it's a direct, real-world analog
 You should always be patient. When a user is vague, help them narrow down their interest. If they state a broad goal like "Geometry" or "High School Math", your job is to help the system build a full curriculum for them.
 Avoid re-introducing yourself. Maintain a continuous, natural conversation.
 """
+INTRODUCTION_PROMPT = "You are introducing yourself as Asmby. Explain that you can teach math from Middle School through College, and can teach specific topics or whole subjects. Ask what the user wants to learn."
+MASTER_INTENTS = ("Simple_Question", "Review_Refresh", "Targeted_Subject")
+
+# --- Task Prompt Templates ---
+# Each task prompt is one of these fixed instruction blocks, then "\n---\n" and the per-call values, so the
+# instruction prefix is byte-identical across users and stays eligible for Gemini's implicit prefix caching
+ROUTER_PROMPT = """You are the master router for a multi-modal learning AI. Analyze the user's message given at the end.
+Classify it into ONE of the following modes:
+- Simple_Question: The user is asking a direct, factual question (e.g., "what is a logarithm?").
+- Review_Refresh: The user wants to review, refresh, or "go over" a topic they may have learned before.
+- Targeted_Subject: The user has a specific new skill or subject they want to learn from the ground up (e.g., "teach me about derivatives", "I want to learn Geometry").
+For Review_Refresh and Targeted_Subject, also categorize the learning goal as 'educational_stage', 'topic_group', or 'skill', using the available stages and topics listed at the end.
+Respond ONLY with a single minified JSON object: {"intent": "<mode>", "scope": {"type": "<educational_stage|topic_group|skill>", "value": "<the stage, topic, or skill name>"}}"""
+SCOPE_PROMPT = """Analyze the user's learning goal given at the end. Categorize it as 'educational_stage', 'topic_group', or 'skill', using the available stages and topics listed at the end.
+Respond ONLY with a single minified JSON object: {"type": "...", "value": "..."}"""
+SIMPLE_QUESTION_PROMPT = "The user has asked the direct question given at the end. Provide a clear, concise answer. After answering, ask them if they would like to start a full lesson on that topic."
+CRAWL_PROMPT = "Explain the skill given at the end, following its guide."
+WALK_ASK_PROMPT = "Create a simple, focused, guided practice question for the skill given at the end."
+RUN_ASK_PROMPT = "Create one direct, single-concept assessment question for the skill given at the end."
+EVALUATION_PROMPT = """A user was asked the question given at the end and gave the response given at the end.
+Your task is to: 1. Praise what is CORRECT. 2. Gently identify ONE area for improvement. 3. Determine if they can proceed.
+Respond ONLY with JSON: {"can_proceed": boolean, "collaborative_feedback": "Your full, conversational response here."}"""
+EVALUATE_AND_NEXT_PROMPT = """A user was asked the question given at the end and gave the response given at the end.
+Your task is to: 1. Praise what is CORRECT. 2. Gently identify ONE area for improvement. 3. Determine if they can proceed.
+4. If they can proceed, create one direct, single-concept assessment question for the skill given at the end.
+Respond ONLY with JSON: {"can_proceed": boolean, "collaborative_feedback": "Your full, conversational response here.", "next_question": "The assessment question, or an empty string."}"""
+# Unambiguous openings that route without asking the model; anything else still goes to the AI router
+MASTER_INTENT_RULES = (
+    (re.compile(r"^\s*(review|refresh|revisit|go over)\b", re.I), "Review_Refresh"),
+    (re.compile(r"^\s*(teach me|i want to learn|i'd like to learn|help me learn)\b", re.I), "Targeted_Subject"),
+    (re.compile(r"^\s*(what|why) (is|are|does|do)\b.*\?\s*$", re.I), "Simple_Question"),
+)
+ACCESS_CODE_ADJECTIVES = ('wise', 'happy', 'clever', 'brave', 'shiny')
+ACCESS_CODE_NOUNS = ('fox', 'river', 'stone', 'star', 'moon')
+ACCESS_CODE_ATTEMPTS = 5
+DB_POOL_SIZE, DB_POOL_ATTEMPTS = 20, 3
 
 # --- Configuration & Initialization ---
-load_dotenv(); app = FastAPI()
-app.add_middleware(CORSMiddleware, allow_origins=["http://ai-tutor.local", "*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+load_dotenv(); app = FastAPI(default_response_class=ORJSONResponse) # JSON bodies are encoded with orjson, like sessions and SSE events
+# Explicit origins only: with credentials on, "*" makes Starlette echo back any requesting Origin. CORS_ORIGINS is a comma list
+# ("a, b" is fine) for other front-end hosts. max_age lets browsers cache the preflight for a day instead of repeating it before every POST.
+CORS_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "http://ai-tutor.local").split(",") if o.strip()]
+app.add_middleware(CORSMiddleware, allow_origins=CORS_ORIGINS, allow_credentials=True,
+                   allow_methods=["*"], allow_headers=["*"], max_age=86400)
+class JSONOnlyGZipMiddleware(GZipMiddleware):
+    """GZip for the JSON endpoints; /chat/stream bypasses it so SSE deltas are never held in the compressor's buffer."""
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == "/chat/stream": await self.app(scope, receive, send)
+        else: await super().__call__(scope, receive, send)
+app.add_middleware(JSONOnlyGZipMiddleware, minimum_size=512) # Tutor replies are long, compressible text
 try:
     genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-    request_options = {"timeout": 120}; generative_model = genai.GenerativeModel('gemini-1.5-flash')
+    # The persona goes in system_instruction once, instead of being prepended to every prompt
+    request_options = {"timeout": 120}; generative_model = genai.GenerativeModel('gemini-1.5-flash', system_instruction=SYSTEM_PERSONA_PROMPT)
 except Exception as e:
     print(f"Error configuring Google AI: {e}"); generative_model = None
 
 # --- Pydantic Models & DB Helpers ---
 class ChatRequest(BaseModel): message: str; access_code: Optional[str] = None
 class ChatResponse(BaseModel): reply: str; access_code: str
+db_pool: Optional[pooling.MySQLConnectionPool] = None; _db_pool_lock = threading.Lock()
+def get_db_pool() -> Optional[pooling.MySQLConnectionPool]:
+    # Created on first use rather than at import, so a database that is down at boot is retried on later requests
+    global db_pool
+    if db_pool: return db_pool
+    with _db_pool_lock:
+        if db_pool is None:
+            # pool_reset_session=False skips a COM_RESET_CONNECTION round trip per checkout; open transactions are rolled back before release instead.
+            # The connector uses its C extension when installed and silently falls back to pure Python otherwise, so make the fallback visible.
+            if not mysql.connector.HAVE_CEXT: print("Warning: mysql-connector C extension unavailable; using the slower pure-Python protocol")
+            # init_command lifts GROUP_CONCAT's 1024-byte default so a long mastered-skill list in get_or_create_user is never truncated.
+            try: db_pool = pooling.MySQLConnectionPool(pool_name="tutor", pool_size=DB_POOL_SIZE, pool_reset_session=False,
+                                                       init_command="SET SESSION group_concat_max_len = 1048576",
+                                                       host=os.getenv("DB_HOST"), user=os.getenv("DB_USER"), password=os.getenv("DB_PASSWORD"), database=os.getenv("DB_NAME"))
+            except mysql.connector.Error as e: print(f"Error creating DB pool: {e}")
+        return db_pool
+@app.on_event("startup")
+def warm_db_pool():
+    get_db_pool() # Opens all DB_POOL_SIZE connections before the first request instead of during it
+@app.on_event("startup")
+async def size_threadpool():
+    # /chat and /chat/stream turns run in anyio's threadpool (40 threads by default); with one thread per pooled connection,
+    # surplus turns wait for a free thread instead of starting and then failing with "pool exhausted"
+    anyio.to_thread.current_default_thread_limiter().total_tokens = DB_POOL_SIZE
 def get_db_connection():
-    try: return mysql.connector.connect(host=os.getenv("DB_HOST"), user=os.getenv("DB_USER"), password=os.getenv("DB_PASSWORD"), database=os.getenv("DB_NAME"))
-    except mysql.connector.Error as e: print(f"DB Connection Error: {e}"); return None
+    pool = get_db_pool()
+    if not pool: return None
+    for attempt in range(DB_POOL_ATTEMPTS):
+        try: return pool.get_connection() # Checkout pings the connection and reconnects it if MySQL dropped it while idle
+        except pooling.PoolError: time.sleep(0.05 * (attempt + 1)) # Every connection is checked out; back off briefly and retry
+        except mysql.connector.Error as e: print(f"DB Connection Error: {e}"); return None
+    print("DB Connection Error: pool exhausted"); return None
+def generate_access_code() -> str:
+    return f"{secrets.choice(ACCESS_CODE_ADJECTIVES)}-{secrets.choice(ACCESS_CODE_NOUNS)}-{secrets.token_hex(4)}"
 def get_or_create_user(cursor, access_code: Optional[str]) -> Dict:
     if access_code:
-        cursor.execute("SELECT * FROM Users WHERE access_code = %s", (access_code,)); user_record = cursor.fetchone()
+        # Mastered skill ids ride along as a comma list, so planning needs no second query (see mastered_skill_ids)
+        cursor.execute("""SELECT u.user_id, u.access_code, u.session_state, u.session_version, GROUP_CONCAT(us.skill_id) AS mastered_skill_ids
+                          FROM Users u LEFT JOIN User_Skills us ON us.user_id = u.user_id WHERE u.access_code = %s GROUP BY u.user_id""", (access_code,))
+        user_record = cursor.fetchone()
         if user_record: return user_record
-    while True:
-        new_code = f"{random.choice(['wise', 'happy', 'clever', 'brave', 'shiny'])}-{random.choice(['fox', 'river', 'stone', 'star', 'moon'])}-{secrets.randbelow(100)}"
-        cursor.execute("SELECT user_id FROM Users WHERE access_code = %s", (new_code,));
-        if not cursor.fetchone():
-            cursor.execute("INSERT INTO Users (access_code) VALUES (%s)", (new_code,)); user_id = cursor.lastrowid
-            cursor.execute("SELECT * FROM Users WHERE user_id = %s", (user_id,)); return cursor.fetchone()
+    for _ in range(ACCESS_CODE_ATTEMPTS): # The UNIQUE key on access_code rejects a collision, so no pre-check SELECT
+        new_code = generate_access_code()
+        # Plain INSERT rather than INSERT IGNORE: IGNORE would also turn an over-long code into a silent truncation
+        try: cursor.execute("INSERT INTO Users (access_code) VALUES (%s)", (new_code,))
+        except mysql.connector.IntegrityError as e:
+            if e.errno == errorcode.ER_DUP_ENTRY: continue
+            raise
+        return {"user_id": cursor.lastrowid, "access_code": new_code, "session_state": None, "session_version": 0, "mastered_skill_ids": None}
+    raise RuntimeError("Could not allocate a unique access code.")
 
 # --- Knowledge Graph & AI Helpers ---
 def get_all_skills_with_details(cursor) -> Dict[int, Dict]:
-    skills_dict = {}; cursor.execute("SELECT * FROM Skills")
+    skills_dict = {}; cursor.execute("SELECT skill_id, skill_name, crawl_prompt, educational_stage, topic_group FROM Skills")
     for row in cursor.fetchall(): skills_dict[row['skill_id']] = row
     return skills_dict
-def get_mastered_skills(cursor, user_id):
-    cursor.execute("SELECT skill_id FROM User_Skills WHERE user_id = %s", (user_id,)); return {row['skill_id'] for row in cursor.fetchall()}
-def get_all_prerequisites_for_skill_list(cursor, skill_ids: List[int]) -> Dict[int, Set[int]]:
-    prereqs = {skill_id: set() for skill_id in skill_ids}
-    if not skill_ids: return prereqs
-    placeholders = ','.join(['%s'] * len(skill_ids))
-    cursor.execute(f"SELECT skill_id, prerequisite_id FROM Prerequisites WHERE skill_id IN ({placeholders})", tuple(skill_ids))
-    for row in cursor.fetchall(): prereqs[row['skill_id']].add(row['prerequisite_id'])
-    return prereqs
+def mastered_skill_ids(user_record) -> Set[int]:
+    # Parsed on demand: only plan building needs the set, most turns never touch it
+    return {int(sid) for sid in (user_record.get('mastered_skill_ids') or '').split(',') if sid}
+def get_all_prerequisites(cursor) -> Dict[int, List[int]]:
+    prereqs = defaultdict(list); cursor.execute("SELECT skill_id, prerequisite_id FROM Prerequisites")
+    for row in cursor.fetchall(): prereqs[row['skill_id']].append(row['prerequisite_id'])
+    return dict(prereqs)
+def get_prerequisite_closure(prerequisites: Dict[int, List[int]], skill_ids: List[int]) -> Dict[int, List[int]]:
+    # BFS over the cached graph: every skill reachable from skill_ids, mapped to its direct prerequisites
+    closure = {}; to_visit = deque(skill_ids)
+    while to_visit:
+        skill_id = to_visit.popleft()
+        if skill_id in closure: continue
+        closure[skill_id] = prerequisites.get(skill_id, []); to_visit.extend(closure[skill_id])
+    return closure
 def mark_skill_as_mastered(cursor, user_id, skill_id):
     cursor.execute("INSERT IGNORE INTO User_Skills (user_id, skill_id) VALUES (%s, %s)", (user_id, skill_id))
 
-def ask_ai(prompt):
-    full_prompt = f"{SYSTEM_PERSONA_PROMPT}\n\n--- TASK ---\n\n{prompt}"
+# --- Skill Catalog Cache ---
+# Skills and Prerequisites are effectively read-only while serving, so the catalog and the prompt text derived from it are
+# built once and shared by every request, then rebuilt after SKILL_CATALOG_TTL_SECONDS to pick up content edits
+SKILL_CATALOG_TTL_SECONDS = 300
+_skill_catalog: Optional[Dict] = None; _skill_catalog_lock = threading.Lock()
+def get_skill_catalog(cursor) -> Dict:
+    global _skill_catalog
+    catalog = _skill_catalog
+    if catalog and time.monotonic() - catalog['loaded_at'] < SKILL_CATALOG_TTL_SECONDS: return catalog
+    with _skill_catalog_lock: # One request rebuilds; the rest wait and reuse its result
+        if _skill_catalog is catalog:
+            skills, prerequisites = get_all_skills_with_details(cursor), get_all_prerequisites(cursor)
+            # Lookup indexes for goal scoping, so a plan never scans every skill
+            skills_by_stage, skills_by_topic, skill_id_by_name = defaultdict(list), defaultdict(list), {}
+            for sid, s in skills.items():
+                if s.get('educational_stage'): skills_by_stage[s['educational_stage']].append(sid)
+                if s.get('topic_group'): skills_by_topic[s['topic_group']].append(sid)
+                skill_id_by_name.setdefault(s['skill_name'].lower(), sid)
+            # Lower-cased stage/topic/skill name -> scope, for goals that name one outright; broader scopes win on a shared name
+            scope_by_name = {}
+            for stage in skills_by_stage: scope_by_name.setdefault(stage.lower(), {"type": "educational_stage", "value": stage})
+            for topic in skills_by_topic: scope_by_name.setdefault(topic.lower(), {"type": "topic_group", "value": topic})
+            for s in skills.values(): scope_by_name.setdefault(s['skill_name'].lower(), {"type": "skill", "value": s['skill_name']})
+            _skill_catalog = {"skills": skills, "prerequisites": prerequisites,
+                              "skills_by_stage": dict(skills_by_stage), "skills_by_topic": dict(skills_by_topic), "skill_id_by_name": skill_id_by_name, "scope_by_name": scope_by_name,
+                              "scope_prompt_section": f"Available Stages: {'; '.join(sorted(skills_by_stage))}. Available Topics: {'; '.join(sorted(skills_by_topic))}.",
+                              "plans": {}, "loaded_at": time.monotonic()} # plans: (scope_type, scope_value) -> ordered skill ids, rebuilt with the catalog
+        return _skill_catalog
+def invalidate_skill_catalog():
+    global _skill_catalog
+    with _skill_catalog_lock: _skill_catalog = None
+@app.on_event("startup")
+def warm_skill_catalog():
+    # Loads the catalog before the first request; if the database is down at boot, the first request loads it instead
+    db = get_db_connection()
+    if not db: return
+    try: get_skill_catalog(db.cursor(dictionary=True))
+    except mysql.connector.Error as e: print(f"Error warming skill catalog: {e}")
+    finally:
+        try:
+            if db.in_transaction: db.rollback() # The catalog SELECTs open a transaction; pool_reset_session=False won't end it
+        except mysql.connector.Error: pass
+        db.close()
+
+# --- AI Response Cache ---
+class TTLCache:
+    """Thread-safe LRU map whose entries also expire after a per-entry TTL."""
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries, self.ttl_seconds = max_entries, ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[float, object]]" = OrderedDict(); self._lock = threading.Lock()
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None: return None
+            if entry[0] < time.monotonic(): del self._entries[key]; return None
+            self._entries.move_to_end(key); return entry[1]
+    def put(self, key, value, ttl_seconds: Optional[float] = None):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + (ttl_seconds or self.ttl_seconds), value); self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries: self._entries.popitem(last=False)
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            return entry[1] if entry is not None and entry[0] >= time.monotonic() else None
+    def clear(self):
+        with self._lock: self._entries.clear()
+
+AI_CACHE_MAX_ENTRIES, AI_CACHE_TTL_SECONDS = 2048, 3600
+# Routing, goal parsing and grading replies depend only on their prompt, so they are kept far longer than conversational text
+AI_CACHE_JUDGEMENT_TTL_SECONDS = 7 * 24 * 3600
+ai_response_cache = TTLCache(AI_CACHE_MAX_ENTRIES, AI_CACHE_TTL_SECONDS)
+
+# Set by /chat/stream for the duration of a turn; ask_ai(..., stream=True) forwards each Gemini chunk to it
+stream_sink: ContextVar[Optional[Callable[[str], None]]] = ContextVar("stream_sink", default=None)
+
+# Cacheable calls already in flight, keyed like the cache: concurrent identical prompts wait for one Gemini call
+_pending_ai_calls: Dict[str, threading.Event] = {}; _pending_ai_calls_lock = threading.Lock()
+
+# At most GEMINI_MAX_CONCURRENCY calls in flight per process, so a burst of users queues here instead of tripping the API quota;
+# quota and timeout errors are retried with backoff (outside the semaphore) unless a stream already sent text to the client.
+# Waiting for a slot, every attempt and every backoff share one request_options["timeout"] budget, so a call never outlives it.
+GEMINI_MAX_CONCURRENCY, GEMINI_ATTEMPTS = 8, 3
+gemini_slots = threading.BoundedSemaphore(GEMINI_MAX_CONCURRENCY)
+RETRYABLE_AI_ERRORS = (google_exceptions.ResourceExhausted, google_exceptions.DeadlineExceeded, google_exceptions.ServiceUnavailable)
+
+def generate_ai_text(prompt, sink=None, generation_config=None) -> Optional[str]:
+    deadline = time.monotonic() + request_options["timeout"]
+    for attempt in range(GEMINI_ATTEMPTS):
+        chunks = []
+        if not gemini_slots.acquire(timeout=max(deadline - time.monotonic(), 0)): print("AI Error: no Gemini slot freed up in time"); return None
+        try:
+            options = {**request_options, "timeout": max(deadline - time.monotonic(), 1)}
+            if not sink: return generative_model.generate_content(prompt, generation_config=generation_config, request_options=options).text.strip()
+            for chunk in generative_model.generate_content(prompt, generation_config=generation_config, stream=True, request_options=options):
+                chunks.append(chunk.text); sink(chunk.text)
+            return "".join(chunks).strip()
+        except RETRYABLE_AI_ERRORS as e: error = e
+        except Exception as e: print(f"AI Error: {e}"); return None
+        finally: gemini_slots.release()
+        backoff = min(0.5 * 2 ** attempt, 4)
+        if chunks or attempt == GEMINI_ATTEMPTS - 1 or time.monotonic() + backoff >= deadline: print(f"AI Error: {error}"); return None
+        time.sleep(backoff)
+
+def generate_ai_text_cached(prompt, sink=None, generation_config=None, cache_ttl=None, cache_text=None) -> Optional[str]:
+    # cache_text, when given, stands in for the prompt in the key (e.g. the prompt with a normalized answer)
+    cache_key = hashlib.blake2b((cache_text or prompt).encode() + (json_dumps(generation_config).encode() if generation_config else b""), digest_size=16).hexdigest()
+    while True:
+        with _pending_ai_calls_lock:
+            cached = ai_response_cache.get(cache_key)
+            if cached is None:
+                pending = _pending_ai_calls.get(cache_key)
+                if pending is None: pending = _pending_ai_calls[cache_key] = threading.Event(); break # This thread makes the call
+        if cached is not None:
+            if sink: sink(cached)
+            return cached
+        pending.wait(request_options["timeout"]) # Then re-check: the cache has the result, or the call failed and this thread retries it
+    try:
+        text = generate_ai_text(prompt, sink, generation_config)
+        if text is not None: ai_response_cache.put(cache_key, text, cache_ttl)
+        return text
+    finally:
+        with _pending_ai_calls_lock: del _pending_ai_calls[cache_key]
+        pending.set()
+
+def ask_ai(prompt, stream=False, cache=False, generation_config=None, cache_ttl=None, cache_text=None):
+    # cache=True is for prompts fully described by their text, with no conversation history: the deterministic judgements (routing,
+    # goal parsing, grading a given answer) and, on the default 1 h TTL, replies any learner may share (the introduction, a simple question)
     if not generative_model: return "AI model not configured."
-    try: return generative_model.generate_content(full_prompt, request_options=request_options).text.strip()
-    except Exception as e: print(f"AI Error: {e}"); return "Sorry, I had trouble thinking."
+    sink = stream_sink.get() if stream else None
+    text = generate_ai_text_cached(prompt, sink, generation_config, cache_ttl, cache_text) if cache else generate_ai_text(prompt, sink, generation_config)
+    return text if text is not None else "Sorry, I had trouble thinking."
+
+# --- Speculative Prefetch ---
+# Some turns end in a phase whose next reply is fully determined (e.g. Summary -> Crawl of the next skill), so that
+# Gemini call is started in the background as soon as the turn is saved and picked up by the learner's next message
+PREFETCH_WORKERS, PREFETCH_MAX_ENTRIES, PREFETCH_TTL_SECONDS = 4, 1024, 900
+prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+prefetched_replies = TTLCache(PREFETCH_MAX_ENTRIES, PREFETCH_TTL_SECONDS) # Per-user futures, keyed by prompt hash
+
+def prefetch_key(user_id, prompt) -> str:
+    return f"{user_id}:{hashlib.blake2b(prompt.encode(), digest_size=16).hexdigest()}"
+
+def prefetch_ai_text(user_id, prompt):
+    if not generative_model: return
+    key = prefetch_key(user_id, prompt)
+    if prefetched_replies.get(key) is None: prefetched_replies.put(key, prefetch_executor.submit(generate_ai_text, prompt))
+
+def ask_ai_prefetched(user_id, prompt, stream=False):
+    # Consumes the prefetched reply for this exact prompt (waiting for it if still running), else calls Gemini as usual
+    future, text = prefetched_replies.pop(prefetch_key(user_id, prompt)), None
+    if future is not None:
+        try: text = future.result(timeout=request_options["timeout"])
+        except Exception: text = None
+    if text is None: return ask_ai(prompt, stream=stream)
+    sink = stream_sink.get() if stream else None
+    if sink: sink(text)
+    return text
+
+# --- Structured Output ---
+# JSON replies are requested with response_mime_type + a schema, so Gemini emits bare JSON (no ```json fences or prose)
+def json_generation_config(schema: Dict, **options) -> Dict:
+    return {"response_mime_type": "application/json", "response_schema": schema, **options}
+
+# Classifiers only emit a label and a short scope, so their output is capped and made deterministic (which also suits the response cache)
+CLASSIFIER_OPTIONS = {"max_output_tokens": 128, "temperature": 0}
+
+SCOPE_SCHEMA = {"type": "OBJECT", "properties": {
+    "type": {"type": "STRING", "enum": ["educational_stage", "topic_group", "skill"]}, "value": {"type": "STRING"}}, "required": ["type", "value"]}
+ROUTER_CONFIG = json_generation_config({"type": "OBJECT", "properties": {
+    "intent": {"type": "STRING", "enum": list(MASTER_INTENTS)}, "scope": SCOPE_SCHEMA}, "required": ["intent"]}, **CLASSIFIER_OPTIONS)
+SCOPE_CONFIG = json_generation_config(SCOPE_SCHEMA, **CLASSIFIER_OPTIONS)
+EVALUATION_CONFIG = json_generation_config({"type": "OBJECT", "properties": {
+    "can_proceed": {"type": "BOOLEAN"}, "collaborative_feedback": {"type": "STRING"}}, "required": ["can_proceed", "collaborative_feedback"]})
+EVALUATION_WITH_NEXT_CONFIG = json_generation_config({"type": "OBJECT", "properties": {
+    "can_proceed": {"type": "BOOLEAN"}, "collaborative_feedback": {"type": "STRING"}, "next_question": {"type": "STRING"}},
+    "required": ["can_proceed", "collaborative_feedback", "next_question"]})
+
+def parse_ai_json(response_text) -> Optional[Dict]:
+    try: result = json_loads(response_text)
+    except orjson.JSONDecodeError: return None # e.g. the "trouble thinking" fallback text
+    return result if isinstance(result, dict) else None
+
+def parse_evaluation(response_text):
+    return parse_ai_json(response_text) or {"can_proceed": False, "collaborative_feedback": "I had trouble evaluating that. Let's try another way."}
+
+def normalize_message(user_message) -> str:
+    # Classifier prompts embed user text in this form so "Teach me  Algebra" and "teach me algebra" share one cached reply
+    return " ".join(user_message.lower().split())
 
 def collaborative_evaluation_with_ai(question, user_answer):
-    prompt = f"""A user was asked: '{question}'. They responded: '{user_answer}'.
-    Your task is to: 1. Praise what is CORRECT. 2. Gently identify ONE area for improvement. 3. Determine if they can proceed.
-    Respond ONLY with JSON: {{"can_proceed": boolean, "collaborative_feedback": "Your full, conversational response here."}}"""
-    response_text = ask_ai(prompt)
-    try:
-        if "```json" in response_text: response_text = response_text.split("```json")[1].split("```")[0].strip()
-        return json.loads(response_text)
-    except (json.JSONDecodeError, IndexError):
-        return {"can_proceed": False, "collaborative_feedback": "I had trouble evaluating that. Let's try another way."}
+    # The grader sees the answer as typed; the cache key only collapses whitespace, keeping case (A∪B vs a∪b, N vs n)
+    prompt = f"{EVALUATION_PROMPT}\n---\nQuestion: {question}\nResponse: "
+    return parse_evaluation(ask_ai(prompt + user_answer, cache=True, generation_config=EVALUATION_CONFIG, cache_ttl=AI_CACHE_JUDGEMENT_TTL_SECONDS,
+                                   cache_text=prompt + " ".join(user_answer.split())))
+
+def evaluate_and_generate_next(question, user_answer, skill_name):
+    # Grades a practice answer and, when it passes, writes the assessment question in the same Gemini round trip
+    prompt = f"{EVALUATE_AND_NEXT_PROMPT}\n---\nSkill: {skill_name}\nQuestion: {question}\nResponse: "
+    return parse_evaluation(ask_ai(prompt + user_answer, cache=True, generation_config=EVALUATION_WITH_NEXT_CONFIG, cache_ttl=AI_CACHE_JUDGEMENT_TTL_SECONDS,
+                                   cache_text=prompt + " ".join(user_answer.split())))
 
 # --- V2: Master Intent Router ---
-def classify_master_intent(session, user_message):
+SCOPE_MATCH_CUTOFF = 0.9 # difflib ratio: tolerates a typo or two in a name, not a different name
+def match_scope(catalog, text) -> Optional[Dict]:
+    # A goal that is just a stage, topic or skill name (give or take a typo) is scoped locally instead of by Gemini
+    name = normalize_message(text).strip(" .!?")
+    if not name: return None
+    scope = catalog['scope_by_name'].get(name)
+    if scope is None:
+        close = difflib.get_close_matches(name, catalog['scope_by_name'].keys(), n=1, cutoff=SCOPE_MATCH_CUTOFF)
+        if close: scope = catalog['scope_by_name'][close[0]]
+    return scope
+
+def classify_message(session, user_message, catalog) -> Tuple[str, Optional[Dict]]:
+    # Returns (intent, scope); scope is the parsed learning goal when the same Gemini call could categorize it, else None
     # If we are in a lesson, assume they are answering
-    if session.get("phase") not in [None, "Awaiting_Goal"]:
-        return "Answering_Question"
+    if session.get("phase") not in (None, "Awaiting_Goal"):
+        return "Answering_Question", None
+    for pattern, intent in MASTER_INTENT_RULES:
+        match = pattern.match(user_message)
+        if match: return intent, (match_scope(catalog, user_message[match.end():]) if intent != "Simple_Question" else None) # "teach me Geometry"
+    scope = match_scope(catalog, user_message)
+    if scope: return "Targeted_Subject", scope # A bare name like "geometry" is a request to learn it
         
-    prompt = f"""You are the master router for a multi-modal learning AI. Analyze the user's message: '{user_message}'.
-    Classify it into ONE of the following modes. Respond ONLY with the category name:
-    - Simple_Question: The user is asking a direct, factual question (e.g., "what is a logarithm?").
-    - Review_Refresh: The user wants to review, refresh, or "go over" a topic they may have learned before.
-    - Targeted_Subject: The user has a specific new skill or subject they want to learn from the ground up (e.g., "teach me about derivatives", "I want to learn Geometry").
-    """
-    intent = ask_ai(prompt)
-    for valid in ["Simple_Question", "Review_Refresh", "Targeted_Subject"]:
-        if valid in intent: return valid
-    return "Targeted_Subject" # Default to building a new path
+    prompt = f"{ROUTER_PROMPT}\n---\n{catalog['scope_prompt_section']}\nMessage: {normalize_message(user_message)}"
+    result = parse_ai_json(ask_ai(prompt, cache=True, generation_config=ROUTER_CONFIG, cache_ttl=AI_CACHE_JUDGEMENT_TTL_SECONDS)) or {}
+    intent = result.get("intent")
+    if intent not in MASTER_INTENTS: return "Targeted_Subject", None # Default to building a new path
+    scope = result.get("scope")
+    if intent == "Simple_Question" or not isinstance(scope, dict) or not scope.get("value"): return intent, None
+    return intent, scope
 
 # --- V2: Specialized Handlers ---
 def handle_simple_question(user_message):
-    prompt = f"The user has asked a direct question: '{user_message}'. Provide a clear, concise answer. After answering, ask them if they would like to start a full lesson on that topic."
-    return ask_ai(prompt), {"phase": "Awaiting_Goal"}
+    prompt = f"{SIMPLE_QUESTION_PROMPT}\n---\nQuestion: {user_message}"
+    return ask_ai(prompt, stream=True, cache=True), {"phase": "Awaiting_Goal"}
+
+# --- V2: Lesson Phase Handlers ---
+# Each handler takes (session, user_message, all_skills, user_id, cursor) and returns (ai_response, session, continue_loop)
+def current_skill(session, all_skills) -> Dict:
+    return all_skills[session['current_skill_id']] # resume_current_skill has already checked it is in the catalog
+
+def resume_current_skill(session, all_skills) -> Optional[Tuple[str, Dict]]:
+    # Run once per turn before the phase handlers: re-resolves a missing current_skill_id from the plan, and when a catalog
+    # reload has dropped the skill, moves on to the next plan skill still in the catalog (or ends the plan) instead of failing mid-lesson
+    plan, index = session.get('learning_plan', []), session.get('current_skill_index', 0)
+    if session.get('phase') == 'Crawl':
+        if index >= len(plan): return None # Crawl ends a finished plan itself
+        skill_id = plan[index] # Crawl starts the next plan skill, so whatever skill came before no longer matters
+    else: skill_id = session.get('current_skill_id', plan[index] if index < len(plan) else None)
+    if skill_id in all_skills: session['current_skill_id'] = skill_id; return None
+    remaining = [sid for sid in plan[index + 1:] if sid in all_skills]
+    if not remaining: return "That learning path has changed since we started, so let's set a new goal. What would you like to learn?", {"phase": "Awaiting_Goal"}
+    session = {"learning_plan": remaining, "current_skill_index": 0, "phase": "Crawl"}
+    return f"That lesson has been updated since we started, so let's move on to **{all_skills[remaining[0]]['skill_name']}**. Ready to continue?", session
+
+def crawl_prompt(skill_record) -> str:
+    return f"{CRAWL_PROMPT}\n---\nSkill: {skill_record['skill_name']}\nGuide: {skill_record['crawl_prompt']}"
+
+def handle_crawl(session, user_message, all_skills, user_id, cursor):
+    plan, index = session.get('learning_plan', []), session.get('current_skill_index', 0)
+    if index >= len(plan): return "Congratulations! You've completed your learning plan. What's next?", {"phase": "Awaiting_Goal"}, False
+    skill_record = all_skills[plan[index]]
+    session['current_skill_id'] = skill_record['skill_id']
+    ai_response, session['phase'] = ask_ai_prefetched(user_id, crawl_prompt(skill_record), stream=True), 'Walk_Ask'
+    return ai_response, session, False
+
+def walk_ask_prompt(skill_record) -> str:
+    return f"{WALK_ASK_PROMPT}\n---\nSkill: {skill_record['skill_name']}"
+
+def handle_walk_ask(session, user_message, all_skills, user_id, cursor):
+    question = ask_ai_prefetched(user_id, walk_ask_prompt(current_skill(session, all_skills)), stream=True)
+    session['last_question'], session['phase'] = question, 'Walk_Evaluate'
+    return question, session, False
+
+def handle_walk_evaluate(session, user_message, all_skills, user_id, cursor):
+    evaluation = evaluate_and_generate_next(session['last_question'], user_message, current_skill(session, all_skills)['skill_name'])
+    ai_response, next_question = evaluation.get('collaborative_feedback', 'Got it.'), evaluation.get('next_question')
+    if evaluation.get('can_proceed') and next_question:
+        session['last_question'], session['phase'] = next_question, 'Run_Evaluate'
+        return f"{ai_response}\n\n{next_question}", session, False
+    if evaluation.get('can_proceed'): session['phase'] = 'Run_Ask'; return ai_response, session, True # No question came back; generate it separately
+    session['phase'] = "Crawl" # Re-explain if they struggle with practice
+    return ai_response + "\n\nLet's review the main idea once more to be sure.", session, False
+
+def handle_run_ask(session, user_message, all_skills, user_id, cursor):
+    prompt = f"{RUN_ASK_PROMPT}\n---\nSkill: {current_skill(session, all_skills)['skill_name']}"
+    question = ask_ai(prompt, stream=True)
+    session['last_question'], session['phase'] = question, 'Run_Evaluate'
+    return question, session, False
+
+def handle_run_evaluate(session, user_message, all_skills, user_id, cursor):
+    evaluation = collaborative_evaluation_with_ai(session['last_question'], user_message)
+    ai_response = evaluation.get('collaborative_feedback', 'Got it.')
+    if evaluation.get('can_proceed'): session['phase'] = 'Summary'; return ai_response, session, True
+    session['phase'] = 'Crawl'
+    return ai_response + "\n\nLet's review this concept one more time.", session, False
+
+def handle_summary(session, user_message, all_skills, user_id, cursor):
+    skill_record = current_skill(session, all_skills)
+    mark_skill_as_mastered(cursor, user_id, skill_record['skill_id'])
+    ai_response = f"Excellent! You've mastered **{skill_record['skill_name']}**."
+    session['current_skill_index'] += 1
+    plan, index = session.get('learning_plan', []), session.get('current_skill_index', 0)
+    if index < len(plan):
+        session['phase'] = 'Crawl'
+        return ai_response + f"\n\nThe next step on our path is **{all_skills[plan[index]]['skill_name']}**. Ready to continue?", session, False
+    return ai_response + "\n\nCongratulations! You've completed your entire learning plan. What's next?", {"phase": "Awaiting_Goal"}, False
+
+PHASE_HANDLERS: Dict[str, Callable] = {
+    "Crawl": handle_crawl, "Walk_Ask": handle_walk_ask, "Walk_Evaluate": handle_walk_evaluate,
+    "Run_Ask": handle_run_ask, "Run_Evaluate": handle_run_evaluate, "Summary": handle_summary,
+}
+
+def prefetch_next_reply(user_id, session, all_skills):
+    # Called once a turn is saved: starts the next turn's Gemini call when the phase makes its prompt predictable.
+    # Best effort only: the turn is already committed, so a failure here (e.g. a plan id dropped by a catalog reload) is just logged.
+    try:
+        plan, index = session.get('learning_plan', []), session.get('current_skill_index', 0)
+        if session.get('phase') == 'Crawl' and index < len(plan) and plan[index] in all_skills: prefetch_ai_text(user_id, crawl_prompt(all_skills[plan[index]]))
+        elif session.get('phase') == 'Walk_Ask' and session.get('current_skill_id') in all_skills: prefetch_ai_text(user_id, walk_ask_prompt(all_skills[session['current_skill_id']]))
+    except Exception as e: print(f"Prefetch Error: {e}")
 
 def handle_lesson_flow(session, user_message, all_skills, user_id, cursor):
-    continue_loop = True
-    ai_response = "Something went wrong in the lesson flow."
+    resumed = resume_current_skill(session, all_skills)
+    if resumed: return resumed
+    ai_response, continue_loop = "Something went wrong in the lesson flow.", True
     while continue_loop:
-        phase = session.get("phase", "Awaiting_Goal"); continue_loop = False
-        
-        if phase == "Crawl":
-            plan, index = session.get('learning_plan', []), session.get('current_skill_index', 0)
-            if index < len(plan):
-                skill_record = all_skills[plan[index]]
-                session['current_skill_record'] = skill_record
-                prompt = f"Explain '{skill_record['skill_name']}'. Guide: '{skill_record['crawl_prompt']}'"
-                ai_response, session['phase'] = ask_ai(prompt), 'Walk_Ask'
-            else: # Plan complete
-                ai_response, session = "Congratulations! You've completed your learning plan. What's next?", {"phase": "Awaiting_Goal"}
-        
-        elif phase == "Walk_Ask":
-            prompt = f"Create a simple, focused, guided practice question for '{session['current_skill_record']['skill_name']}'."
-            question = ask_ai(prompt)
-            ai_response, session['last_question'], session['phase'] = question, question, 'Walk_Evaluate'
-
-        elif phase == "Walk_Evaluate":
-            evaluation = collaborative_evaluation_with_ai(session['last_question'], user_message)
-            ai_response = evaluation.get('collaborative_feedback')
-            if evaluation.get('can_proceed'): session['phase'], continue_loop = 'Run_Ask', True
-            else:
-                ai_response += "\n\nLet's review the main idea once more to be sure."
-                session['phase'] = "Crawl" # Re-explain if they struggle with practice
-
-        elif phase == "Run_Ask":
-            prompt = f"Create one direct, single-concept assessment question for '{session['current_skill_record']['skill_name']}'."
-            question = ask_ai(prompt)
-            ai_response, session['last_question'], session['phase'] = question, question, 'Run_Evaluate'
-
-        elif phase == "Run_Evaluate":
-            evaluation = collaborative_evaluation_with_ai(session['last_question'], user_message)
-            ai_response = evaluation.get('collaborative_feedback', 'Got it.')
-            if evaluation.get('can_proceed'): session['phase'], continue_loop = 'Summary', True
-            else: ai_response += "\n\nLet's review this concept one more time."; session['phase'] = 'Crawl'
-
-        elif phase == "Summary":
-            skill_record = session['current_skill_record']
-            mark_skill_as_mastered(cursor, user_id, skill_record['skill_id'])
-            ai_response = f"Excellent! You've mastered **{skill_record['skill_name']}**."
-            session['current_skill_index'] += 1
-            plan, index = session.get('learning_plan', []), session.get('current_skill_index', 0)
-            if index < len(plan):
-                next_skill_name = all_skills[plan[index]]['skill_name']
-                ai_response += f"\n\nThe next step on our path is **{next_skill_name}**. Ready to continue?"
-                session['phase'] = 'Crawl'
-            else:
-                ai_response += "\n\nCongratulations! You've completed your entire learning plan. What's next?"
-                session = {"phase": "Awaiting_Goal"}
-    
+        phase_handler = PHASE_HANDLERS.get(session.get("phase", "Awaiting_Goal"))
+        if not phase_handler: break
+        ai_response, session, continue_loop = phase_handler(session, user_message, all_skills, user_id, cursor)
     return ai_response, session
 
-def build_plan_and_start(user_message, all_skills, cursor, user_id, is_review_mode=False):
+def build_plan_and_start(user_message, catalog, user_record, is_review_mode=False, scope=None):
     # This function handles both Targeted_Subject and Review_Refresh
-    stages = sorted(list(set(s['educational_stage'] for s in all_skills.values() if s.get('educational_stage'))))
-    topics = sorted(list(set(s['topic_group'] for s in all_skills.values() if s.get('topic_group'))))
-    prompt = f"Analyze the user's learning goal: '{user_message}'. Categorize it as 'educational_stage', 'topic_group', or 'skill'. Available Stages: {stages}. Available Topics: {topics}. Respond ONLY with a single minified JSON object."
-    try:
-        request_details = json.loads(ask_ai(prompt))
-        scope_type, scope_value = request_details.get("type"), request_details.get("value")
-    except (json.JSONDecodeError, IndexError):
-        scope_type, scope_value = "skill", user_message
+    all_skills = catalog['skills']
+    if scope is None: # The router matched a rule or its reply carried no usable scope, so categorize the goal here
+        prompt = f"{SCOPE_PROMPT}\n---\n{catalog['scope_prompt_section']}\nGoal: {normalize_message(user_message)}"
+        scope = parse_ai_json(ask_ai(prompt, cache=True, generation_config=SCOPE_CONFIG, cache_ttl=AI_CACHE_JUDGEMENT_TTL_SECONDS)) or {"type": "skill", "value": user_message}
+    scope_type, scope_value = scope.get("type"), scope.get("value")
 
     if not scope_value:
         return "I'm having trouble understanding that goal. Could you be more specific?", {"phase": "Awaiting_Goal"}
 
     # Build the full curriculum for the scope
-    full_plan = build_learning_plan_from_scope(cursor, all_skills, scope_type, scope_value)
+    full_plan = list(get_learning_plan(catalog, scope_type, scope_value))
     
     plan_to_learn = full_plan
     if not is_review_mode:
-        mastered_skills = get_mastered_skills(cursor, user_id)
+        mastered_skills = mastered_skill_ids(user_record)
         plan_to_learn = [sid for sid in full_plan if sid not in mastered_skills]
 
     if not plan_to_learn:
@@ -189,71 +533,151 @@ def build_plan_and_start(user_message, all_skills, cursor, user_id, is_review_mo
     session = {"learning_plan": plan_to_learn, "current_skill_index": 0, "phase": "Crawl"}
     return ai_response, session
 
-def build_learning_plan_from_scope(cursor, all_skills, scope_type, scope_value):
-    target_skill_ids = []
-    if scope_type == 'educational_stage': target_skill_ids = [sid for sid, s in all_skills.items() if s.get('educational_stage') == scope_value]
-    elif scope_type == 'topic_group': target_skill_ids = [sid for sid, s in all_skills.items() if s.get('topic_group') == scope_value]
+def get_learning_plan(catalog, scope_type, scope_value) -> Tuple[int, ...]:
+    # A plan depends only on the catalog, so each scope is ordered once per catalog load
+    plan = catalog['plans'].get((scope_type, scope_value))
+    if plan is None: plan = catalog['plans'][(scope_type, scope_value)] = tuple(build_learning_plan_from_scope(catalog, scope_type, scope_value))
+    return plan
+
+def build_learning_plan_from_scope(catalog, scope_type, scope_value):
+    all_skills = catalog['skills']
+    if scope_type == 'educational_stage': target_skill_ids = catalog['skills_by_stage'].get(scope_value, [])
+    elif scope_type == 'topic_group': target_skill_ids = catalog['skills_by_topic'].get(scope_value, [])
     else:
-        for sid, s in all_skills.items():
-            if s['skill_name'].lower() == scope_value.lower(): target_skill_ids = [sid]; break
-    plan = []; prereqs = get_all_prerequisites_for_skill_list(cursor, list(all_skills.keys()))
-    skills_in_plan = set(target_skill_ids)
-    to_add = set(target_skill_ids)
-    while to_add:
-        current_id = to_add.pop()
-        skill_prereqs = prereqs.get(current_id, set())
-        for prereq_id in skill_prereqs:
-            if prereq_id not in skills_in_plan: skills_in_plan.add(prereq_id); to_add.add(prereq_id)
+        sid = catalog['skill_id_by_name'].get(scope_value.lower()); target_skill_ids = [sid] if sid is not None else []
+    plan = []; prereqs = get_prerequisite_closure(catalog['prerequisites'], target_skill_ids)
+    skills_in_plan = {sid for sid in prereqs if sid in all_skills}
     in_degree = {u: 0 for u in skills_in_plan}; adj = {u: [] for u in skills_in_plan}
     for u in skills_in_plan:
-        for v in prereqs.get(u, set()):
+        for v in prereqs.get(u, []):
             if v in skills_in_plan: in_degree[u] += 1; adj[v].append(u)
-    queue = [u for u in skills_in_plan if in_degree[u] == 0]
+    queue = deque(u for u in skills_in_plan if in_degree[u] == 0)
     while queue:
-        u = queue.pop(0); plan.append(u)
+        u = queue.popleft(); plan.append(u)
         for v in adj.get(u, []):
             in_degree[v] -= 1
             if in_degree[v] == 0: queue.append(v)
     return plan
 
-# --- Main Chat Endpoint ---
-@app.post("/chat", response_model=ChatResponse)
-async def chat_handler(req: ChatRequest):
+# --- Turn Processing & Session Persistence ---
+def run_chat_turn(cursor, user_record, user_message, catalog):
+    user_id, all_skills = user_record['user_id'], catalog['skills']
+    session = json_loads(user_record.get('session_state') or '{}') or {"phase": "Awaiting_Goal"}
+    if 'current_skill_record' in session: session['current_skill_id'] = session.pop('current_skill_record')['skill_id'] # Sessions saved before skills were stored by id
+
+    if user_message == "##INITIALIZE##" and session.get("phase") != "Awaiting_Goal": # Resuming only replays the last reply; the session is left as-is
+        return f"[Resuming Session]\n\n{session.get('last_ai_reply', 'Welcome back!')}", session
+
+    if user_message == "##INITIALIZE##":
+        ai_response = ask_ai(INTRODUCTION_PROMPT, stream=True, cache=True)
+    else:
+        master_intent, scope = classify_message(session, user_message, catalog)
+
+        if master_intent == "Simple_Question":
+            ai_response, session = handle_simple_question(user_message)
+        
+        elif master_intent == "Review_Refresh":
+            ai_response, session = build_plan_and_start(user_message, catalog, user_record, is_review_mode=True, scope=scope)
+
+        elif master_intent == "Targeted_Subject":
+            ai_response, session = build_plan_and_start(user_message, catalog, user_record, is_review_mode=False, scope=scope)
+
+        else: # Answering_Question, which triggers the lesson flow
+            ai_response, session = handle_lesson_flow(session, user_message, all_skills, user_id, cursor)
+    
+    session['last_ai_reply'] = ai_response
+    return ai_response, session
+
+def save_session(cursor, user_record, session) -> bool:
+    # Compare-and-swap on session_version: returns False if a concurrent turn for this user already wrote a newer state
+    session_state = json_dumps(session)
+    if session_state == user_record.get('session_state'): return True # Unchanged turn (e.g. a resume): skip the write entirely
+    cursor.execute("UPDATE Users SET session_state = %s, session_version = session_version + 1 WHERE user_id = %s AND session_version = %s",
+                   (session_state, user_record['user_id'], user_record['session_version']))
+    return cursor.rowcount == 1
+
+def session_basis(user_record) -> Tuple:
+    # What a message is an answer to; replaying a turn is only meaningful while this is unchanged
+    session = json_loads(user_record.get('session_state') or '{}') or {}
+    return session.get('phase', 'Awaiting_Goal'), session.get('last_question')
+
+# One turn per access code at a time in this process; concurrent duplicates (double-clicks, retries) get a 429
+# instead of spending Gemini calls on a turn that would lose the session_version race anyway
+_turns_in_flight: Set[str] = set(); _turns_in_flight_lock = threading.Lock()
+@contextmanager
+def claim_turn(access_code: str):
+    with _turns_in_flight_lock:
+        if access_code in _turns_in_flight: raise HTTPException(status_code=429, detail="Still working on your previous message.")
+        _turns_in_flight.add(access_code)
+    try: yield
+    finally:
+        with _turns_in_flight_lock: _turns_in_flight.discard(access_code)
+
+# --- Main Chat Endpoints ---
+def process_chat_request(req: ChatRequest) -> ChatResponse:
     db = get_db_connection();
     if not db: raise HTTPException(status_code=500, detail="Database connection failed.")
     cursor = db.cursor(dictionary=True)
     
     try:
-        user_record = get_or_create_user(cursor, req.access_code); db.commit()
-        access_code, user_id = user_record['access_code'], user_record['user_id']
-        session = json.loads(user_record.get('session_state') or '{}') or {"phase": "Awaiting_Goal"}
-        user_message = req.message
-        all_skills = get_all_skills_with_details(cursor)
-
-        if user_message == "##INITIALIZE##":
-            prompt = "You are introducing yourself as Asmby. Explain that you can teach math from Middle School through College, and can teach specific topics or whole subjects. Ask what the user wants to learn."
-            ai_response = ask_ai(prompt) if session.get("phase") == "Awaiting_Goal" else f"[Resuming Session]\n\n{session.get('last_ai_reply', 'Welcome back!')}"
-        else:
-            master_intent = classify_master_intent(session, user_message)
-
-            if master_intent == "Simple_Question":
-                ai_response, session = handle_simple_question(user_message)
-            
-            elif master_intent == "Review_Refresh":
-                ai_response, session = build_plan_and_start(user_message, all_skills, cursor, user_id, is_review_mode=True)
-
-            elif master_intent == "Targeted_Subject":
-                ai_response, session = build_plan_and_start(user_message, all_skills, cursor, user_id, is_review_mode=False)
-
-            else: # Answering_Question, which triggers the lesson flow
-                ai_response, session = handle_lesson_flow(session, user_message, all_skills, user_id, cursor)
-        
-        session['last_ai_reply'] = ai_response
-        cursor.execute("UPDATE Users SET session_state = %s WHERE user_id = %s", (json.dumps(session), user_id)); db.commit()
-        return ChatResponse(reply=ai_response, access_code=access_code)
+        user_record = get_or_create_user(cursor, req.access_code) # A new user's INSERT commits together with its first session write
+        access_code = user_record['access_code']
+        catalog = get_skill_catalog(cursor)
+
+        with claim_turn(access_code):
+            basis = session_basis(user_record)
+            for attempt in range(2):
+                ai_response, session = run_chat_turn(cursor, user_record, req.message, catalog)
+                if save_session(cursor, user_record, session):
+                    db.commit(); prefetch_next_reply(user_record['user_id'], session, catalog['skills'])
+                    return ChatResponse(reply=ai_response, access_code=access_code)
+                db.rollback(); user_record = get_or_create_user(cursor, access_code)
+                # Lost the race: replay once, but only if the winner left the same phase and question (e.g. it only refreshed
+                # last_ai_reply). Otherwise the message answered something that has moved on, and replaying would misgrade it.
+                if session_basis(user_record) != basis: break
+                stream_sink.set(None) # Don't stream the replay: its text would append to the deltas already sent; "done" carries it
+        raise HTTPException(status_code=409, detail="Your session was updated by another request. Please try again.")
+    except HTTPException: raise
     except Exception as e:
         print(f"--- ERROR IN HANDLER ---\n{traceback.format_exc()}--- END ERROR ---")
         raise HTTPException(status_code=500, detail=f"An internal error occurred.")
     finally:
-        if db and db.is_connected(): db.close()
+        try:
+            if db.in_transaction: db.rollback() # Never hand an open transaction back to the pool; committed turns skip the round trip
+        except mysql.connector.Error: pass
+        db.close() # Returns the connection to the pool
+
+@app.post("/chat", response_model=ChatResponse)
+def chat_handler(req: ChatRequest):
+    # Plain def: FastAPI runs it in its threadpool, so the blocking MySQL and Gemini calls no longer stall the event loop
+    return process_chat_request(req)
+
+_stream_turns: Set[asyncio.Future] = set() # Strong references so running stream turns are not garbage-collected
+@app.post("/chat/stream")
+async def chat_stream_handler(req: ChatRequest):
+    # Server-sent events: "delta" events carry model text as it is generated, then a single "done" event
+    # carries the authoritative ChatResponse (or "error" with the HTTP detail). Deltas are a preview only.
+    # The turn holds a threadpool token (and a DB connection) like /chat; the response side just awaits the queue, so an open
+    # stream costs no worker thread while Gemini generates.
+    loop, events = asyncio.get_running_loop(), asyncio.Queue()
+    def emit(event): loop.call_soon_threadsafe(events.put_nowait, event)
+    def run_turn():
+        stream_sink.set(lambda text: emit(("delta", {"text": text})))
+        try: emit(("done", process_chat_request(req).model_dump()))
+        except HTTPException as e: emit(("error", {"status_code": e.status_code, "detail": e.detail}))
+        finally: emit(None)
+    turn = asyncio.ensure_future(anyio.to_thread.run_sync(run_turn)) # Runs to completion (and saves) even if the client disconnects
+    _stream_turns.add(turn); turn.add_done_callback(_stream_turns.discard)
+    async def event_stream():
+        while (event := await events.get()) is not None:
+            name, data = event; yield f"event: {name}\ndata: {json_dumps(data)}\n\n"
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
 
+# --- Admin Endpoints ---
+@app.post("/skills/invalidate")
+def invalidate_skills_handler(x_admin_token: Optional[str] = Header(None)):
+    # Call after editing Skills or Prerequisites so the next request reloads them instead of waiting out the TTL
+    admin_token = os.getenv("ADMIN_TOKEN")
+    if not admin_token or not secrets.compare_digest(x_admin_token or "", admin_token): raise HTTPException(status_code=403, detail="Forbidden.")
+    invalidate_skill_catalog()
+    return {"status": "invalidated"}
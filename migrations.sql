@@ -0,0 +1,15 @@
+-- Schema changes applied on top of the base Users / Skills / Prerequisites / User_Skills tables.
+-- Run in order against the tutor database; each statement is needed by the current main.py.
+
+-- Optimistic concurrency for session_state: every write bumps the version and only succeeds against the version it read.
+ALTER TABLE Users ADD COLUMN session_version INT NOT NULL DEFAULT 0;
+
+-- Access codes are generated optimistically and inserted directly; the database rejects duplicates.
+ALTER TABLE Users ADD UNIQUE KEY uk_access_code (access_code);
+
+-- Generated codes are up to 21 characters (adjective-noun-8 hex digits); make sure the column can hold them whole.
+ALTER TABLE Users MODIFY access_code VARCHAR(32) NOT NULL;
+
+-- Hot lookup: the mastered-skill LEFT JOIN in get_or_create_user (User_Skills by user_id).
+-- Skip it if the table's primary key already starts with these columns. Prerequisites is only ever read whole into the skill catalog.
+CREATE INDEX idx_user_skills_user ON User_Skills (user_id, skill_id);